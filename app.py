@@ -1,10 +1,13 @@
 from flask import Flask, render_template, request, jsonify
+from werkzeug.utils import secure_filename
 import os
-from populate_database import clear_database, load_documents, split_documents, add_to_chroma, add_documents_to_chroma
-from query_data import query_rag
+from populate_database import clear_database, load_documents, split_chunks, add_to_chroma, add_documents_to_chroma, index_document, ingest_sharded, get_database_for_source
+from query_data import aquery_rag, MIN_RELEVANCE_SCORE
 from langchain_community.document_loaders import PyPDFDirectoryLoader, PyPDFLoader
 from get_embedding_function import get_embedding_function
-from langchain_chroma import Chroma
+from get_database import get_database
+from profiling import profiled, PROFILE_DIR
+from shards import read_shard_manifest, SHARD_MANIFEST
 import shutil
 from ollama import Client
 
@@ -18,6 +21,23 @@ config = {
 }
 
 
+# Endpoints that can be profiled. RAG_PROFILE=1 records every call; an
+# endpoint armed through /api/profile_next records its next call only.
+PROFILED_ENDPOINTS = ('process_database', 'query')
+profile_next_calls = set()
+
+
+def should_profile(endpoint):
+    # Only asked once the profiler is free, so an armed call is not used up
+    # while another run is being recorded.
+    if os.environ.get('RAG_PROFILE') == '1':
+        return True
+    if endpoint in profile_next_calls:
+        profile_next_calls.discard(endpoint)
+        return True
+    return False
+
+
 @app.route('/')
 def index():
     return render_template('index.html')
@@ -47,7 +67,31 @@ def get_config():
     return jsonify(config)
 
 
+def get_chunking_params(data, chunking_method):
+    """Pick the chunker parameters for ``chunking_method`` out of request data.
+
+    Values are cast to int so the same helper works for JSON bodies and
+    multipart form fields.
+    """
+    def as_int(key, default):
+        value = data.get(key)
+        return int(value) if value not in (None, '') else default
+
+    if chunking_method == 'recursive':
+        return {
+            'chunk_size': as_int('chunk_size', 800),
+            'chunk_overlap': as_int('chunk_overlap', 80)
+        }
+    # semantic
+    return {
+        'n_clusters': as_int('n_clusters', None),
+        'min_chunk_size': as_int('min_chunk_size', 100),
+        'max_chunk_size': as_int('max_chunk_size', 1000)
+    }
+
+
 @app.route('/api/process_database', methods=['POST'])
+@profiled('process_database', should_profile)
 def process_database():
     data = request.json
     should_reset = data.get('reset', False)
@@ -62,18 +106,22 @@ def process_database():
                 print(f"Deleted database at {config['CHROMA_PATH']}")
 
         # Get chunking parameters based on method
-        chunking_params = {}
-        if chunking_method == 'recursive':
-            chunking_params = {
-                'chunk_size': data.get('chunk_size', 800),
-                'chunk_overlap': data.get('chunk_overlap', 80)
-            }
-        else:  # semantic
-            chunking_params = {
-                'n_clusters': data.get('n_clusters'),
-                'min_chunk_size': data.get('min_chunk_size', 100),
-                'max_chunk_size': data.get('max_chunk_size', 1000)
-            }
+        chunking_params = get_chunking_params(data, chunking_method)
+
+        # Sharded ingestion: one worker process and Chroma shard per shard.
+        # An existing sharded database keeps its shard count.
+        num_shards = int(data.get('num_shards') or 0)
+        manifest = read_shard_manifest(config['CHROMA_PATH'])
+        if not num_shards and manifest is not None:
+            num_shards = manifest['num_shards']
+        if num_shards:
+            num_chunks = ingest_sharded(config['DATA_PATH'], config['CHROMA_PATH'], num_shards,
+                                        chunking_method=chunking_method, **chunking_params)
+            return jsonify({
+                "status": "success",
+                "message": f"Database processed successfully into {num_shards} shards using {chunking_method} chunking",
+                "num_chunks": num_chunks
+            })
 
         # Load and process documents
         documents = []
@@ -85,13 +133,12 @@ def process_database():
                 documents.extend(loader.load())
 
         print(f"Using {chunking_method} chunking with parameters: {chunking_params}")
-        chunks = split_documents(documents,
-                               chunking_method=chunking_method,
-                               **chunking_params)
+        chunks = split_chunks(documents,
+                              chunking_method=chunking_method,
+                              **chunking_params)
 
         # Create new database instance AFTER potential reset
-        db = Chroma(persist_directory=config['CHROMA_PATH'],
-                   embedding_function=get_embedding_function())
+        db = get_database(config['CHROMA_PATH'])
 
         # Modified add_to_chroma function that takes the db instance
         add_documents_to_chroma(chunks, db)
@@ -109,25 +156,128 @@ def process_database():
         }), 500
 
 
-@app.route('/api/query', methods=['POST'])
-def query():
-    data = request.json
-    question = data.get('question')
+@app.route('/api/upload_document', methods=['POST'])
+def upload_document():
+    """Save one uploaded PDF into DATA_PATH and index only that file."""
+    uploaded = request.files.get('file')
+    if uploaded is None or not uploaded.filename:
+        return jsonify({
+            "status": "error",
+            "message": "No file provided"
+        }), 400
+
+    filename = secure_filename(uploaded.filename)
+    if not filename.lower().endswith(".pdf"):
+        return jsonify({
+            "status": "error",
+            "message": "Only PDF documents are supported"
+        }), 400
+
+    chunking_method = request.form.get('chunking_method', 'recursive')
 
     try:
-        response = query_rag(question)
-        # Just return the full response without trying to split it
+        chunking_params = get_chunking_params(request.form, chunking_method)
+
+        # Stream the upload straight to disk; use the same absolute path as
+        # process_database so chunk IDs match a later full directory pass.
+        os.makedirs(config['DATA_PATH'], exist_ok=True)
+        document_path = os.path.abspath(os.path.join(config['DATA_PATH'], filename))
+        # A file with the same name is only replaced once the new one has
+        # been indexed; on failure it is put back, matching the index again.
+        upload_path = f"{document_path}.upload"
+        previous_path = f"{document_path}.previous"
+        uploaded.save(upload_path)
+        had_previous = os.path.exists(document_path)
+        if had_previous:
+            os.replace(document_path, previous_path)
+        os.replace(upload_path, document_path)
+        print(f'Saved upload: {document_path}')
+
+        try:
+            db = get_database_for_source(config['CHROMA_PATH'], document_path)
+            new_chunk_ids = index_document(document_path, db,
+                                           chunking_method=chunking_method,
+                                           **chunking_params)
+        except Exception:
+            if had_previous:
+                os.replace(previous_path, document_path)
+            else:
+                os.remove(document_path)
+            raise
+        if had_previous:
+            os.remove(previous_path)
+
         return jsonify({
             "status": "success",
-            "response": response,  # The full response including sources
+            "message": f"Indexed {filename} using {chunking_method} chunking",
+            "num_chunks": len(new_chunk_ids),
+            "chunk_ids": new_chunk_ids
         })
     except Exception as e:
+        print(f"Error in upload_document: {str(e)}")
         return jsonify({
             "status": "error",
             "message": str(e)
         }), 500
 
 
+@app.route('/api/query', methods=['POST'])
+async def query():
+    payload, status = await answer_query(request.json)
+    return jsonify(payload), status
+
+
+@profiled('query', should_profile)
+async def answer_query(data):
+    """
+    Answer one /api/query request body; returns (payload, HTTP status).
+
+    Shared by the Flask view above and the native ASGI route in asgi.py.
+    """
+    question = data.get('question')
+    filters = data.get('filters')
+    min_score = data.get('min_score')
+    if min_score is None:
+        min_score = MIN_RELEVANCE_SCORE
+
+    try:
+        response = await aquery_rag(question, filters=filters, min_score=float(min_score))
+        # Just return the full response without trying to split it
+        return {
+            "status": "success",
+            "response": response,  # The full response including sources
+        }, 200
+    except Exception as e:
+        return {
+            "status": "error",
+            "message": str(e)
+        }, 500
+
+
+@app.route('/api/profile_next', methods=['POST'])
+def profile_next():
+    """Record cProfile and tracemalloc data for the next call of an endpoint."""
+    data = request.json or {}
+    endpoint = data.get('endpoint')
+    if endpoint not in PROFILED_ENDPOINTS:
+        return jsonify({
+            "status": "error",
+            "message": f"endpoint must be one of {list(PROFILED_ENDPOINTS)}"
+        }), 400
+
+    profile_next_calls.add(endpoint)
+    return jsonify({
+        "status": "success",
+        "message": f"Next {endpoint} call will be profiled to {PROFILE_DIR}"
+    })
+
+
+@app.route('/api/embedding_metrics')
+def embedding_metrics():
+    """Batch-size and wait-time figures for the query embedding micro-batcher."""
+    return jsonify(get_embedding_function().metrics())
+
+
 # @app.route('/api/list_models')
 # def list_models():
 #     # You might want to implement actual model discovery
@@ -181,11 +331,12 @@ def list_models():
 @app.route('/api/list_databases')
 def list_databases():
     try:
-        # Look for directories containing chroma.sqlite3
+        # Look for directories containing chroma.sqlite3 or a shard manifest
         databases = []
         for item in os.listdir():
             db_path = os.path.join(item, 'chroma.sqlite3')
-            if os.path.isdir(item) and os.path.exists(db_path):
+            manifest_path = os.path.join(item, SHARD_MANIFEST)
+            if os.path.isdir(item) and (os.path.exists(db_path) or os.path.exists(manifest_path)):
                 databases.append(item)
 
         print(f"Found databases: {databases}")
@@ -0,0 +1,29 @@
+from asgiref.wsgi import WsgiToAsgi
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+from starlette.routing import Mount, Route
+
+from app import app as flask_app, answer_query
+
+"""
+ASGI entry point for production serving:
+
+    uvicorn asgi:application --host 0.0.0.0 --port 5000
+
+/api/query is served natively, so every in-flight question is a coroutine on
+one shared event loop rather than a blocked worker thread; a single process
+can hold hundreds of them while Ollama generates. All other routes are the
+unchanged Flask app, run on asgiref's thread pool.
+"""
+
+
+async def query(request: Request):
+    payload, status = await answer_query(await request.json())
+    return JSONResponse(payload, status_code=status)
+
+
+application = Starlette(routes=[
+    Route('/api/query', query, methods=['POST']),
+    Mount('/', app=WsgiToAsgi(flask_app)),
+])
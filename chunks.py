@@ -0,0 +1,67 @@
+import os
+from langchain.schema.document import Document
+
+"""
+Compact chunk records used between splitting and the Chroma write
+"""
+
+
+class Chunk:
+    """
+    A single chunk of a page.
+
+    ``page_metadata`` is the metadata dict of the page the chunk came from.
+    It is shared by reference between all chunks of that page and must not be
+    mutated; per-chunk fields live in slots and are only merged into a
+    metadata dict by to_document(), right before writing to Chroma.
+    """
+
+    __slots__ = ('page_content', 'page_metadata', 'id', 'chunk_type', 'chunk_index',
+                 'total_chunks', 'original_length', 'error')
+
+    def __init__(self, page_content: str, page_metadata: dict, chunk_type: str = None,
+                 chunk_index: int = None, total_chunks: int = None,
+                 original_length: int = None, error: str = None):
+        self.page_content = page_content
+        self.page_metadata = page_metadata
+        self.id = None
+        self.chunk_type = chunk_type
+        self.chunk_index = chunk_index
+        self.total_chunks = total_chunks
+        self.original_length = original_length
+        self.error = error
+
+    @property
+    def source(self):
+        return self.page_metadata.get("source")
+
+    @property
+    def page(self):
+        return self.page_metadata.get("page")
+
+    def to_document(self) -> Document:
+        """Build the langchain Document, with the same metadata keys the splitters used to write."""
+        metadata = dict(self.page_metadata)
+        if self.chunk_type is not None:
+            metadata['chunk_type'] = self.chunk_type
+        if self.chunk_index is not None:
+            metadata['chunk_index'] = self.chunk_index
+            metadata['total_chunks'] = self.total_chunks
+            metadata['original_length'] = self.original_length
+            metadata['chunk_length'] = len(self.page_content)
+        if self.error is not None:
+            metadata['error'] = self.error
+        if self.id is not None:
+            metadata['id'] = self.id
+            metadata['source_name'] = os.path.basename(self.source or "")
+        return Document(page_content=self.page_content, metadata=metadata)
+
+
+def to_documents(chunks: list[Chunk]) -> list[Document]:
+    return [chunk.to_document() for chunk in chunks]
+
+
+def as_chunks(chunks) -> list[Chunk]:
+    """Accept Chunk records or already split Documents; Documents are wrapped as Chunks."""
+    return [Chunk(chunk.page_content, chunk.metadata) if isinstance(chunk, Document) else chunk
+            for chunk in chunks]
@@ -0,0 +1,28 @@
+from langchain_chroma import Chroma
+
+from get_embedding_function import get_embedding_function
+
+# New collections use cosine distance, so relevance scores are plain cosine
+# similarities and the thresholds in query_data mean the same thing for every
+# database.
+COLLECTION_CONFIGURATION = {"hnsw": {"space": "cosine"}}
+
+
+def get_database(persist_directory: str, embedding_function=None):
+    """
+    Open (or create) the Chroma database at ``persist_directory``.
+
+    Collections created before cosine distance was configured use Chroma's
+    default squared L2 distance, which langchain maps to relevance with
+    1 - d/sqrt(2) and which goes negative for unrelated text. For unit-length
+    embeddings (what Ollama returns) the squared L2 distance is 2 - 2*cosine,
+    so those collections are scored with 1 - d/2 instead, the exact cosine
+    similarity.
+    """
+    db = Chroma(persist_directory=persist_directory,
+                embedding_function=embedding_function or get_embedding_function(),
+                collection_configuration=COLLECTION_CONFIGURATION)
+    hnsw_config = db._collection.configuration.get("hnsw") or {}
+    if hnsw_config.get("space") == "l2":
+        db.override_relevance_score_fn = lambda distance: 1.0 - distance / 2
+    return db
@@ -1,11 +1,166 @@
+import asyncio
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, InvalidStateError
+
 from langchain_community.embeddings.ollama import OllamaEmbeddings
 # from langchain_community.embeddings.bedrock import BedrockEmbeddings
 from langchain_ollama import OllamaEmbeddings
+from langchain_core.embeddings import Embeddings
+
+from profiling import profile_worker
+
+# Concurrent embed_query calls are grouped for up to EMBEDDING_BATCH_WAIT_MS,
+# or until EMBEDDING_MAX_BATCH_SIZE texts are waiting, and sent as one call.
+EMBEDDING_BATCH_WAIT_MS = 5
+EMBEDDING_MAX_BATCH_SIZE = 32
+# How long a caller waits for its vector before giving up, e.g. when Ollama
+# hangs or the batcher thread has died.
+EMBEDDING_TIMEOUT_S = 60
+
+_embeddings = None
+_embeddings_pid = None
+_embeddings_lock = threading.Lock()
 
 
 def get_embedding_function():
-    # embeddings = BedrockEmbeddings(
-    #     credentials_profile_name="default", region_name="us-east-1"
-    # )
-    embeddings = OllamaEmbeddings(model="nomic-embed-text")
-    return embeddings
+    """
+    Return the process-wide embedding function.
+
+    The same instance is shared by every caller so concurrent queries land in
+    the same micro-batcher. A forked worker process gets its own instance.
+    """
+    global _embeddings, _embeddings_pid
+    with _embeddings_lock:
+        if _embeddings is None or _embeddings_pid != os.getpid():
+            # embeddings = BedrockEmbeddings(
+            #     credentials_profile_name="default", region_name="us-east-1"
+            # )
+            embeddings = OllamaEmbeddings(model="nomic-embed-text")
+            _embeddings = MicroBatchingEmbeddings(embeddings)
+            _embeddings_pid = os.getpid()
+        return _embeddings
+
+
+class MicroBatchingEmbeddings(Embeddings):
+    """
+    Embeddings wrapper that batches concurrent single-text queries.
+
+    embed_query puts the text on a queue and waits. A background thread
+    collects whatever arrives within ``max_wait_ms`` (up to
+    ``max_batch_size`` texts), embeds the group with one embed_documents call
+    and hands each caller its own vector. embed_documents is already batched
+    and goes straight to the wrapped embeddings.
+    """
+
+    def __init__(self, embeddings: Embeddings, max_wait_ms: float = EMBEDDING_BATCH_WAIT_MS,
+                 max_batch_size: int = EMBEDDING_MAX_BATCH_SIZE, timeout: float = EMBEDDING_TIMEOUT_S):
+        self.embeddings = embeddings
+        self.max_wait = max_wait_ms / 1000
+        self.max_batch_size = max_batch_size
+        self.timeout = timeout
+        self._queue = queue.Queue()
+        self._worker = None
+        self._worker_lock = threading.Lock()
+
+        self._metrics_lock = threading.Lock()
+        self._requests = 0
+        self._batches = 0
+        self._largest_batch = 0
+        self._total_wait = 0.0
+        self._max_wait_seen = 0.0
+        self._batch_sizes = {}
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self.embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> list[float]:
+        return self._submit(text).result(timeout=self.timeout)
+
+    async def aembed_query(self, text: str) -> list[float]:
+        return await asyncio.wait_for(asyncio.wrap_future(self._submit(text)), timeout=self.timeout)
+
+    def _submit(self, text: str) -> Future:
+        self._ensure_worker()
+        future = Future()
+        self._queue.put((text, future, time.perf_counter()))
+        return future
+
+    def _ensure_worker(self):
+        with self._worker_lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, name="embedding-batcher", daemon=True)
+                self._worker.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.perf_counter() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            # Skip callers that gave up while queued (an aembed_query timeout
+            # or cancellation cancels its future). The rest can no longer be
+            # cancelled once marked running.
+            batch = [item for item in batch if item[1].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+
+            dispatched_at = time.perf_counter()
+            self._record_batch([dispatched_at - enqueued_at for _text, _future, enqueued_at in batch])
+
+            try:
+                with profile_worker():
+                    vectors = self.embeddings.embed_documents([text for text, _future, _enqueued_at in batch])
+            except Exception as e:
+                for _text, future, _enqueued_at in batch:
+                    _deliver(future.set_exception, e)
+                continue
+            if len(vectors) != len(batch):
+                error = RuntimeError(f"Embedding model returned {len(vectors)} vectors for {len(batch)} texts")
+                for _text, future, _enqueued_at in batch:
+                    _deliver(future.set_exception, error)
+                continue
+            for (_text, future, _enqueued_at), vector in zip(batch, vectors):
+                _deliver(future.set_result, vector)
+
+    def _record_batch(self, waits: list[float]):
+        with self._metrics_lock:
+            size = len(waits)
+            self._requests += size
+            self._batches += 1
+            self._largest_batch = max(self._largest_batch, size)
+            self._total_wait += sum(waits)
+            self._max_wait_seen = max(self._max_wait_seen, max(waits))
+            self._batch_sizes[size] = self._batch_sizes.get(size, 0) + 1
+
+    def metrics(self) -> dict:
+        """Batch-size and queue wait-time figures since startup."""
+        with self._metrics_lock:
+            return {
+                "requests": self._requests,
+                "batches": self._batches,
+                "mean_batch_size": self._requests / self._batches if self._batches else 0.0,
+                "largest_batch": self._largest_batch,
+                "mean_wait_ms": 1000 * self._total_wait / self._requests if self._requests else 0.0,
+                "max_wait_ms": 1000 * self._max_wait_seen,
+                "batch_size_histogram": dict(sorted(self._batch_sizes.items())),
+                "max_wait_window_ms": 1000 * self.max_wait,
+                "max_batch_size": self.max_batch_size,
+            }
+
+
+def _deliver(set_outcome, value):
+    """Complete a caller's future; one that is already done must not stop the batcher."""
+    try:
+        set_outcome(value)
+    except InvalidStateError:
+        pass
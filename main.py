@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import argparse
+import hashlib
 import json
 import os
 import subprocess
@@ -11,15 +12,25 @@ import time
 import re
 
 
+DEFAULT_CACHE_DIR = os.path.expanduser("~/.cache/rag-agent/responses")
+DEFAULT_CACHE_MAX_MB = 256
+DEFAULT_SEED = 42
+
+
 class OllamaClient:
     def __init__(self, host: str = "http://localhost:11434"):
         self.host = host
         self.api_generate = f"{host}/api/generate"
-        self.api_list = f"{host}/api/list"
+        self.api_tags = f"{host}/api/tags"
+
+    @staticmethod
+    def _model_name(model: str) -> str:
+        # Ollama lists untagged models under their :latest tag.
+        return model if ':' in model else f"{model}:latest"
 
     def is_running(self) -> bool:
         try:
-            response = requests.get(self.api_list)
+            response = requests.get(self.api_tags)
             return response.status_code == 200
         except requests.exceptions.ConnectionError:
             return False
@@ -39,10 +50,10 @@ class OllamaClient:
             return False
 
     def ensure_model_exists(self, model: str) -> bool:
-        response = requests.get(self.api_list)
+        response = requests.get(self.api_tags)
         if response.status_code == 200:
             models = response.json().get('models', [])
-            if not any(m['name'] == model for m in models):
+            if not any(m['name'] == self._model_name(model) for m in models):
                 print(f"Model {model} not found. Pulling from repository...")
                 result = subprocess.run(["ollama", "pull", model],
                                         capture_output=True,
@@ -51,10 +62,19 @@ class OllamaClient:
             return True
         return False
 
+    def model_digest(self, model: str) -> Optional[str]:
+        response = requests.get(self.api_tags)
+        if response.status_code == 200:
+            for m in response.json().get('models', []):
+                if m['name'] == self._model_name(model):
+                    return m.get('digest')
+        return None
+
     def generate(self,
                  model: str,
                  prompt: str,
-                 system: Optional[str] = None) -> Optional[str]:
+                 system: Optional[str] = None,
+                 options: Optional[Dict] = None) -> Optional[str]:
         data = {
             "model": model,
             "prompt": prompt,
@@ -62,6 +82,8 @@ class OllamaClient:
         }
         if system:
             data["system"] = system
+        if options:
+            data["options"] = options
 
         try:
             response = requests.post(self.api_generate, json=data)
@@ -75,6 +97,99 @@ class OllamaClient:
             return None
 
 
+class ResponseCache:
+    """Content-addressed on-disk cache of generated responses.
+
+    Entries are keyed by a hash of the model digest, system prompt, prompt and
+    generation options, and stored as <cache_dir>/<hash[:2]>/<hash>.json. Once
+    the cache grows past max_bytes the least recently used entries are
+    deleted. The last digest seen for each model name is kept in models.json
+    so a cache hit needs no call to Ollama at all.
+    """
+
+    def __init__(self, cache_dir: str = DEFAULT_CACHE_DIR,
+                 max_bytes: int = DEFAULT_CACHE_MAX_MB * 1024 * 1024):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.models_path = os.path.join(cache_dir, "models.json")
+
+    @staticmethod
+    def key(model_digest: str,
+            prompt: str,
+            system: Optional[str],
+            options: Optional[Dict]) -> str:
+        payload = json.dumps({
+            "model_digest": model_digest,
+            "system": system,
+            "prompt": prompt,
+            "options": options,
+        }, sort_keys=True)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def get(self, key: str) -> Optional[str]:
+        path = self._path(key)
+        try:
+            with open(path, 'r') as f:
+                entry = json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+        # Mark as recently used for eviction.
+        os.utime(path)
+        return entry.get('response')
+
+    @staticmethod
+    def _write_json(path: str, data: Dict):
+        # Write to a private temp file and rename it into place, so a
+        # concurrent run never reads a half-written file.
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    def put(self, key: str, response: str, model: str):
+        self._write_json(self._path(key), {"model": model, "response": response})
+        self.evict()
+
+    def evict(self):
+        entries = []
+        total = 0
+        for root, _dirs, files in os.walk(self.cache_dir):
+            for name in files:
+                if not name.endswith('.json') or root == self.cache_dir:
+                    continue
+                path = os.path.join(root, name)
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+
+        entries.sort()
+        for _mtime, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            os.remove(path)
+            total -= size
+
+    def _digests(self) -> Dict[str, str]:
+        # A missing or corrupt models.json just means no digest is known yet.
+        try:
+            with open(self.models_path, 'r') as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return {}
+
+    def known_digest(self, model: str) -> Optional[str]:
+        return self._digests().get(model)
+
+    def remember_digest(self, model: str, digest: str):
+        digests = self._digests()
+        digests[model] = digest
+        self._write_json(self.models_path, digests)
+
+
 def extract_code(response: str) -> Optional[Dict[str, str]]:
     """Extract code blocks from the response."""
     # Look for code blocks with language specification
@@ -120,21 +235,8 @@ def execute_code(code: str, language: str) -> Optional[str]:
         return None
 
 
-def main():
-    parser = argparse.ArgumentParser(description='Ollama CLI Interface')
-    parser.add_argument('--model', required=True, help='Model to use')
-    parser.add_argument('--query', help='Query string')
-    parser.add_argument('--file', help='Input file containing query')
-    parser.add_argument('--system', help='System prompt')
-    parser.add_argument('--execute', action='store_true',
-                        help='Execute code if present in response')
-    parser.add_argument('--json', action='store_true',
-                        help='Request JSON output')
-    args = parser.parse_args()
-
-    if not args.query and not args.file:
-        parser.error("Either --query or --file must be provided")
-
+def generate_response(args, query: str, options: Optional[Dict],
+                      cache: Optional[ResponseCache]) -> Optional[str]:
     # Initialize client
     client = OllamaClient()
 
@@ -150,6 +252,44 @@ def main():
         print(f"Error: Could not load model {args.model}")
         sys.exit(1)
 
+    # Generate response
+    response = client.generate(args.model, query, args.system, options)
+
+    if response and cache:
+        digest = client.model_digest(args.model)
+        if digest:
+            cache.remember_digest(args.model, digest)
+            cache.put(cache.key(digest, query, args.system, options), response, args.model)
+        else:
+            print(f"Warning: Could not find the digest of model {args.model}; response not cached")
+    return response
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Ollama CLI Interface')
+    parser.add_argument('--model', required=True, help='Model to use')
+    parser.add_argument('--query', help='Query string')
+    parser.add_argument('--file', help='Input file containing query')
+    parser.add_argument('--system', help='System prompt')
+    parser.add_argument('--execute', action='store_true',
+                        help='Execute code if present in response')
+    parser.add_argument('--json', action='store_true',
+                        help='Request JSON output')
+    parser.add_argument('--deterministic', action='store_true',
+                        help='Generate with a fixed seed and temperature 0, and cache the response')
+    parser.add_argument('--seed', type=int, default=DEFAULT_SEED,
+                        help='Seed used in deterministic mode')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='In deterministic mode, neither read nor write the response cache')
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR,
+                        help='Directory of the response cache')
+    parser.add_argument('--cache-max-mb', type=float, default=DEFAULT_CACHE_MAX_MB,
+                        help='Size limit of the response cache; least recently used entries are evicted')
+    args = parser.parse_args()
+
+    if not args.query and not args.file:
+        parser.error("Either --query or --file must be provided")
+
     # Get query from file or command line
     query = args.query
     if args.file:
@@ -164,8 +304,23 @@ def main():
     if args.json:
         query = f"Please provide your response in valid JSON format. {query}"
 
-    # Generate response
-    response = client.generate(args.model, query, args.system)
+    options = None
+    cache = None
+    if args.deterministic:
+        options = {"seed": args.seed, "temperature": 0}
+        if not args.no_cache:
+            cache = ResponseCache(args.cache_dir,
+                                  max_bytes=int(args.cache_max_mb * 1024 * 1024))
+
+    # A cache hit under the last known model digest skips Ollama entirely
+    response = None
+    if cache:
+        digest = cache.known_digest(args.model)
+        if digest:
+            response = cache.get(cache.key(digest, query, args.system, options))
+
+    if response is None:
+        response = generate_response(args, query, options, cache)
 
     if not response:
         print("Error: No response received")
@@ -1,50 +1,100 @@
 import argparse
+import multiprocessing
 import os
 import shutil
+from concurrent.futures import ProcessPoolExecutor
 from langchain_community.document_loaders import PyPDFDirectoryLoader, PyPDFLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain.schema.document import Document
-from get_embedding_function import get_embedding_function
-from langchain_chroma import Chroma
+from chunks import Chunk, as_chunks, to_documents
+from get_database import get_database
+from profiling import profile_run
+from shards import read_shard_manifest, write_shard_manifest, shard_for_source
 
 
 CHROMA_PATH = "chroma"
 # DATA_PATH = "/home/hemkenhg/workspace/books/rpi"
 DATA_PATH = "/home/hemkenhg/workspace/books/woodworking"
 
+# New chunks are turned into Documents and written this many at a time, so
+# only one batch of full Documents exists next to the compact Chunk records.
+CHROMA_WRITE_BATCH_SIZE = 2000
+
 
 def main():
 
     # Check if the database should be cleared (using the --clear flag).
     parser = argparse.ArgumentParser()
     parser.add_argument("--reset", action="store_true", help="Reset the database.")
+    parser.add_argument("--profile", action="store_true",
+                        help="Record cProfile and tracemalloc data for this run.")
+    parser.add_argument("--shards", type=int, default=None,
+                        help="Ingest in parallel into this many Chroma shards, one worker process each.")
     args = parser.parse_args()
     if args.reset:
         print("✨ Clearing Database")
         clear_database()
 
-    # Create (or update) the data store.
-    documents = load_documents()
-    chunks = split_documents(documents)
-    add_to_chroma(chunks)
+    # An existing sharded database keeps being updated shard by shard.
+    num_shards = args.shards or 0
+    manifest = read_shard_manifest(CHROMA_PATH)
+    if not num_shards and manifest is not None:
+        num_shards = manifest["num_shards"]
+
+    # Create (or update) the data store. Shard workers record their own
+    # profiles; the parent's only covers dispatching and waiting.
+    with profile_run("populate_database", enabled=args.profile):
+        if num_shards:
+            ingest_sharded(DATA_PATH, CHROMA_PATH, num_shards, profile=args.profile)
+        else:
+            documents = load_documents()
+            chunks = split_chunks(documents)
+            add_to_chroma(chunks)
+
+
+def list_documents(data_path=DATA_PATH):
+    """Absolute paths of the PDFs in ``data_path``."""
+    return [
+        os.path.abspath(os.path.join(data_path, document))
+        for document in os.listdir(data_path)
+        if document.endswith(".pdf")
+    ]
 
 
 def load_documents():
     documents = []
-    for document in os.listdir(DATA_PATH):
-        document_path = os.path.abspath(os.path.join(DATA_PATH, document))
-        if document.endswith(".pdf"):
-            print(f'loading: {document_path}')
-            loader = PyPDFLoader(document_path)
-            # Extend the list instead of appending
-            documents.extend(loader.load())
+    for document_path in list_documents(DATA_PATH):
+        # Extend the list instead of appending
+        documents.extend(load_document(document_path))
     return documents
 
 
+def load_document(document_path):
+    """Load the pages of a single PDF."""
+    print(f'loading: {document_path}')
+    loader = PyPDFLoader(document_path)
+    return loader.load()
+
+
 def split_documents(documents: list[Document], chunking_method='recursive', **kwargs):
     """
     Split documents using specified chunking method.
 
+    Args:
+        documents: List of documents to split
+        chunking_method: 'recursive' or 'semantic'
+        **kwargs: Additional arguments for the chunker
+    """
+    return to_documents(split_chunks(documents, chunking_method, **kwargs))
+
+
+def split_chunks(documents: list[Document], chunking_method='recursive', **kwargs) -> list[Chunk]:
+    """
+    Split documents into Chunk records.
+
+    Chunks share their page's metadata dict instead of copying it; they are
+    only turned into Documents when written to Chroma.
+
     Args:
         documents: List of documents to split
         chunking_method: 'recursive' or 'semantic'
@@ -62,7 +112,7 @@ def split_documents(documents: list[Document], chunking_method='recursive', **kw
 
         from semantic_chunking import SemanticChunker
         chunker = SemanticChunker(**semantic_params)
-        return chunker.split_documents(documents)
+        return chunker.split_chunks(documents)
     else:
         # Filter only recursive chunking parameters
         recursive_params = {
@@ -75,85 +125,193 @@ def split_documents(documents: list[Document], chunking_method='recursive', **kw
             length_function=len,
             is_separator_regex=False,
         )
-        return text_splitter.split_documents(documents)
+        return [
+            Chunk(text, document.metadata)
+            for document in documents
+            for text in text_splitter.split_text(document.page_content)
+        ]
 
 
-def add_to_chroma(chunks: list[Document]):
+def add_to_chroma(chunks: list[Chunk | Document]):
     # Load the existing database.
-    db = Chroma(
-        persist_directory=CHROMA_PATH, embedding_function=get_embedding_function()
-    )
+    db = get_database(CHROMA_PATH)
+    add_documents_to_chroma(chunks, db)
 
-    # Calculate Page IDs.
-    chunks_with_ids = calculate_chunk_ids(chunks)
 
-    # Add or Update the documents.
-    existing_items = db.get(include=[])  # IDs are always included by default
-    existing_ids = set(existing_items["ids"])
-    print(f"Number of existing documents in DB: {len(existing_ids)}")
+def add_documents_to_chroma(chunks, db):
+    """Modified version of add_to_chroma that takes db instance as parameter"""
+    return add_new_chunks(chunks, db, existing_ids_in_collection)
 
-    # Only add documents that don't exist in the DB.
-    new_chunks = []
-    for chunk in chunks_with_ids:
-        if chunk.metadata["id"] not in existing_ids:
-            new_chunks.append(chunk)
 
-    if len(new_chunks):
-        print(f"👉 Adding new documents: {len(new_chunks)}")
-        new_chunk_ids = [chunk.metadata["id"] for chunk in new_chunks]
-        db.add_documents(new_chunks, ids=new_chunk_ids)
-        # db.persist()
-    else:
-        print("✅ No new documents to add")
+def existing_ids_in_collection(db, chunk_ids):
+    """Every ID in the collection, fetched in one pass. Suits full directory runs."""
+    return set(db.get(include=[])["ids"])  # IDs are always included by default
 
-def add_documents_to_chroma(chunks, db):
-    """Modified version of add_to_chroma that takes db instance as parameter"""
+
+def no_existing_ids(db, chunk_ids):
+    """Treat every chunk as new. Chroma upserts by ID, so stored chunks with the same ID are overwritten."""
+    return set()
+
+
+def add_new_chunks(chunks, db, lookup_existing_ids):
+    """
+    Add the chunks whose IDs are not in ``db`` yet.
+
+    Args:
+        chunks: Chunks to add, as Chunk records or Documents
+        db: Chroma instance to write to
+        lookup_existing_ids: Called as ``lookup_existing_ids(db, chunk_ids)``;
+            returns the set of those IDs the collection already holds
+
+    Returns:
+        List of the chunk IDs that were added.
+    """
     # Calculate chunk IDs
-    chunks_with_ids = calculate_chunk_ids(chunks)
+    chunks_with_ids = calculate_chunk_ids(as_chunks(chunks))
 
-    # Get existing items from the database
-    existing_items = db.get(include=[])
-    existing_ids = set(existing_items["ids"])
+    existing_ids = lookup_existing_ids(db, [chunk.id for chunk in chunks_with_ids])
     print(f"Number of existing documents in DB: {len(existing_ids)}")
 
-    # Add documents that don't exist in the DB
-    new_chunks = []
-    for chunk in chunks_with_ids:
-        if chunk.metadata["id"] not in existing_ids:
-            new_chunks.append(chunk)
-
+    # Only add documents that don't exist in the DB.
+    new_chunks = [chunk for chunk in chunks_with_ids if chunk.id not in existing_ids]
+    new_chunk_ids = [chunk.id for chunk in new_chunks]
     if new_chunks:
         print(f"👉 Adding new documents: {len(new_chunks)}")
-        new_chunk_ids = [chunk.metadata["id"] for chunk in new_chunks]
-        db.add_documents(new_chunks, ids=new_chunk_ids)
+        for start in range(0, len(new_chunks), CHROMA_WRITE_BATCH_SIZE):
+            end = start + CHROMA_WRITE_BATCH_SIZE
+            db.add_documents(to_documents(new_chunks[start:end]), ids=new_chunk_ids[start:end])
     else:
         print("✅ No new documents to add")
+    return new_chunk_ids
+
+
+def index_document(document_path, db, chunking_method='recursive', **kwargs):
+    """
+    Load, split and embed a single PDF into an existing Chroma instance.
+
+    The file's chunks are all written, overwriting chunks stored under the
+    same IDs, so a changed file replaces its old text instead of being
+    skipped as already present. Chunks previously indexed from the same path
+    that were not rewritten (the file got shorter) are deleted afterwards;
+    if loading or embedding fails, the old chunks stay searchable. The rest
+    of the corpus is neither listed nor re-embedded.
+
+    Args:
+        document_path: Path of the PDF to index
+        db: Chroma instance to write to
+        chunking_method: 'recursive' or 'semantic'
+        **kwargs: Additional arguments for the chunker
+
+    Returns:
+        List of the chunk IDs that were added.
+    """
+    documents = load_document(document_path)
+    chunks = split_chunks(documents, chunking_method=chunking_method, **kwargs)
+
+    previous_ids = db.get(where={"source": document_path}, include=[])["ids"]
+    new_chunk_ids = add_new_chunks(chunks, db, no_existing_ids)
+
+    stale_ids = sorted(set(previous_ids) - set(new_chunk_ids))
+    if stale_ids:
+        print(f"Removing {len(stale_ids)} chunks no longer produced by {document_path}")
+        db.delete(ids=stale_ids)
+    return new_chunk_ids
+
+
+def ingest_sharded(data_path, chroma_path, num_shards, chunking_method='recursive', profile=False, **kwargs):
+    """
+    Ingest the PDFs in ``data_path`` into ``num_shards`` Chroma shards in parallel.
+
+    Files are assigned to shards by a hash of their path and each shard is
+    written by its own worker process, so the single-writer SQLite store of
+    one Chroma database is no longer the bottleneck. The shards and a
+    manifest listing them live under ``chroma_path``. With ``profile`` each
+    worker writes its own populate_database-shard-NN report.
 
-def calculate_chunk_ids(chunks):
+    Returns the number of chunks added across all shards.
+    """
+    manifest = read_shard_manifest(chroma_path)
+    if manifest is None and os.path.exists(os.path.join(chroma_path, "chroma.sqlite3")):
+        raise ValueError(f"{chroma_path} holds an unsharded database; reset it before sharded ingestion")
+    if manifest is not None and manifest["num_shards"] != num_shards:
+        raise ValueError(f"{chroma_path} has {manifest['num_shards']} shards, not {num_shards}; "
+                         f"reset it to change the shard count")
+    manifest = write_shard_manifest(chroma_path, num_shards)
+
+    shard_documents = [[] for _ in range(num_shards)]
+    for document_path in list_documents(data_path):
+        shard_documents[shard_for_source(document_path, num_shards)].append(document_path)
+
+    print(f"Ingesting into {num_shards} shards with {chunking_method} chunking")
+    # Spawned workers start clean instead of inheriting Chroma clients and threads.
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=num_shards, mp_context=context) as executor:
+        futures = [
+            executor.submit(_ingest_shard, os.path.join(chroma_path, shard), document_paths,
+                            chunking_method, kwargs, profile)
+            for shard, document_paths in zip(manifest["shards"], shard_documents)
+            if document_paths
+        ]
+        num_added = sum(future.result() for future in futures)
+
+    print(f"Added {num_added} chunks across {num_shards} shards")
+    return num_added
+
+
+def _ingest_shard(shard_path, document_paths, chunking_method, chunking_params, profile=False):
+    # cProfile does not follow work into other processes, so each worker
+    # profiles itself.
+    with profile_run(f"populate_database-{os.path.basename(shard_path)}", enabled=profile):
+        documents = []
+        for document_path in document_paths:
+            documents.extend(load_document(document_path))
+        chunks = split_chunks(documents, chunking_method=chunking_method, **chunking_params)
+        db = get_database(shard_path)
+        return len(add_documents_to_chroma(chunks, db))
+
+
+def get_database_for_source(chroma_path, source):
+    """Chroma instance that ``source`` belongs in: its shard, or the database itself."""
+    manifest = read_shard_manifest(chroma_path)
+    if manifest is not None:
+        shard = manifest["shards"][shard_for_source(source, manifest["num_shards"])]
+        chroma_path = os.path.join(chroma_path, shard)
+    return get_database(chroma_path)
+
+
+def calculate_chunk_ids(chunks: list[Chunk | Document]):
 
     # This will create IDs like "data/monopoly.pdf:6:2"
     # Page Source : Page Number : Chunk Index
+    # Chunk records get the ID in chunk.id, Documents in metadata["id"].
 
-    last_page_id = None
+    last_page = None
+    page_id = None
     current_chunk_index = 0
 
     for chunk in chunks:
-        source = chunk.metadata.get("source")
-        page = chunk.metadata.get("page")
-        current_page_id = f"{source}:{page}"
+        if isinstance(chunk, Document):
+            page = (chunk.metadata.get("source"), chunk.metadata.get("page"))
+        else:
+            page = (chunk.source, chunk.page)
 
-        # If the page ID is the same as the last one, increment the index.
-        if current_page_id == last_page_id:
+        # If the page is the same as the last one, increment the index.
+        # The page ID string is only built once per page.
+        if page == last_page:
             current_chunk_index += 1
         else:
             current_chunk_index = 0
-
-        # Calculate the chunk ID.
-        chunk_id = f"{current_page_id}:{current_chunk_index}"
-        last_page_id = current_page_id
-
-        # Add it to the page meta-data.
-        chunk.metadata["id"] = chunk_id
+            page_id = f"{page[0]}:{page[1]}"
+            last_page = page
+
+        # Calculate the chunk ID. The file name is added to the metadata
+        # from the source when the chunk is converted to a Document, so
+        # queries can filter on a manual without knowing its indexed path.
+        chunk_id = f"{page_id}:{current_chunk_index}"
+        if isinstance(chunk, Document):
+            chunk.metadata["id"] = chunk_id
+        else:
+            chunk.id = chunk_id
 
     return chunks
 
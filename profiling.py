@@ -0,0 +1,156 @@
+import asyncio
+import cProfile
+import functools
+import io
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+PROFILE_DIR = os.environ.get("RAG_PROFILE_DIR", "profiles")
+TOP_N = 25
+
+# cProfile cannot run two profilers at once, so only one run is recorded at a time.
+_profile_lock = threading.Lock()
+
+# Profilers of worker threads (search pool, embedding batcher) that ran work
+# for the active run; merged into its report. None when nothing is recorded.
+_worker_profilers = None
+_worker_profilers_lock = threading.Lock()
+
+
+@contextmanager
+def profile_run(name: str, enabled: bool = True, output_dir: str = None):
+    """
+    Record cProfile and tracemalloc data for the enclosed block.
+
+    Writes <name>-<timestamp>.prof (loadable with pstats/snakeviz) and a
+    matching .txt report with the hot functions and top allocation sites to
+    ``output_dir``. Yields the report path, or None when profiling is disabled
+    or another run is already being recorded.
+
+    cProfile only traces the thread that enables it; work done on worker
+    threads inside profile_worker() blocks while the run is active is merged
+    into the report. That includes work for other requests running at the
+    same time.
+
+    ``enabled`` may be a callable. It is only called once the profiling lock
+    is held, so a one-shot request to profile is not used up by a call that
+    could not have been profiled anyway.
+    """
+    global _worker_profilers
+    if not enabled or not _profile_lock.acquire(blocking=False):
+        yield None
+        return
+    if callable(enabled) and not enabled():
+        _profile_lock.release()
+        yield None
+        return
+
+    output_dir = output_dir or PROFILE_DIR
+    os.makedirs(output_dir, exist_ok=True)
+    base_path = os.path.join(output_dir, f"{name}-{time.strftime('%Y%m%d-%H%M%S')}")
+
+    was_tracing = tracemalloc.is_tracing()
+    if not was_tracing:
+        tracemalloc.start()
+    tracemalloc.reset_peak()
+    start_snapshot = tracemalloc.take_snapshot()
+
+    with _worker_profilers_lock:
+        _worker_profilers = []
+    profiler = cProfile.Profile()
+    start = time.perf_counter()
+    profiler.enable()
+    try:
+        yield f"{base_path}.txt"
+    finally:
+        profiler.disable()
+        with _worker_profilers_lock:
+            worker_profilers, _worker_profilers = _worker_profilers, None
+        elapsed = time.perf_counter() - start
+        end_snapshot = tracemalloc.take_snapshot()
+        _current, peak = tracemalloc.get_traced_memory()
+        if not was_tracing:
+            tracemalloc.stop()
+        try:
+            _write_report(base_path, name, elapsed, profiler, worker_profilers,
+                          start_snapshot, end_snapshot, peak)
+        finally:
+            _profile_lock.release()
+
+
+@contextmanager
+def profile_worker():
+    """Profile the enclosed work on a worker thread if a profile_run is active."""
+    with _worker_profilers_lock:
+        recording = _worker_profilers is not None
+    if not recording:
+        yield
+        return
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        with _worker_profilers_lock:
+            if _worker_profilers is not None:
+                _worker_profilers.append(profiler)
+
+
+def _write_report(base_path, name, elapsed, profiler, worker_profilers,
+                  start_snapshot, end_snapshot, peak):
+    stats_stream = io.StringIO()
+    stats = pstats.Stats(profiler, stream=stats_stream)
+    for worker_profiler in worker_profilers:
+        stats.add(worker_profiler)
+    stats.dump_stats(f"{base_path}.prof")
+    stats.strip_dirs().sort_stats("cumulative").print_stats(TOP_N)
+
+    ignore = [
+        tracemalloc.Filter(False, tracemalloc.__file__),
+        tracemalloc.Filter(False, __file__),
+    ]
+    allocation_diff = end_snapshot.filter_traces(ignore).compare_to(
+        start_snapshot.filter_traces(ignore), "lineno"
+    )
+
+    with open(f"{base_path}.txt", "w") as f:
+        f.write(f"Profile: {name}\n")
+        f.write(f"Wall time: {elapsed:.3f}s\n")
+        f.write(f"Peak traced memory: {peak / 1024 / 1024:.1f} MiB\n\n")
+        f.write(f"== Top {TOP_N} allocation sites (net new during run) ==\n")
+        for stat in allocation_diff[:TOP_N]:
+            f.write(f"{stat}\n")
+        f.write(f"\n== Top {TOP_N} functions by cumulative time "
+                f"(calling thread + {len(worker_profilers)} worker tasks) ==\n")
+        f.write(stats_stream.getvalue())
+
+    print(f"Profile written to {base_path}.txt and {base_path}.prof")
+
+
+def profiled(name: str, should_profile):
+    """
+    Decorator that wraps a sync or async function in profile_run.
+
+    ``should_profile(name)`` decides whether a call is recorded. It is only
+    asked once no other run holds the profiler.
+    """
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with profile_run(name, enabled=lambda: should_profile(name)):
+                    return await func(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with profile_run(name, enabled=lambda: should_profile(name)):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
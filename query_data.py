@@ -1,13 +1,36 @@
 import argparse
-from langchain_chroma import Chroma
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
 from langchain.prompts import ChatPromptTemplate
 from langchain_ollama import OllamaLLM
 
 from get_embedding_function import get_embedding_function
+from get_database import get_database
+from profiling import profile_worker
+from shards import shard_paths
 
 CHROMA_PATH = "chroma"
 LLM_TO_USE = "llama3.2:3b"
 
+# Relevance scores are cosine similarities (see get_database), higher is
+# better. Chunks below MIN_RELEVANCE_SCORE are dropped; if none are left the
+# LLM is not called. When the top hit reaches STRONG_RELEVANCE_SCORE only
+# STRONG_MATCH_K chunks are sent to the LLM instead of MAX_K.
+# The defaults are deliberately lenient starting points; calibrate them for
+# an embedding model and corpus with `python test_rag.py`, which reports the
+# scores of relevant and off-topic questions and suggests a min_score.
+MAX_K = 5
+STRONG_MATCH_K = 2
+MIN_RELEVANCE_SCORE = 0.3
+STRONG_RELEVANCE_SCORE = 0.8
+
+# Chroma's search is synchronous. Shards of a sharded database are searched in
+# parallel on this shared pool, and the async path uses it to keep the event
+# loop free while SQLite/HNSW do their work.
+SEARCH_WORKERS = 8
+_search_executor = ThreadPoolExecutor(max_workers=SEARCH_WORKERS, thread_name_prefix="chroma-search")
+
 PROMPT_TEMPLATE = """
 Answer the question based only on the following context:
 
@@ -23,31 +46,205 @@ def main():
     # Create CLI.
     parser = argparse.ArgumentParser()
     parser.add_argument("query_text", type=str, help="The query text.")
+    parser.add_argument("--source", help="Only search this document (file name or path).")
+    parser.add_argument("--page", help="Only search this page or page range, e.g. 12 or 10-20.")
+    parser.add_argument("--chunk-type", help="Only search chunks of this type, e.g. semantic.")
+    parser.add_argument("--filter", action="append", default=[], metavar="KEY=VALUE",
+                        help="Filter on any other chunk metadata field. Can be repeated.")
+    parser.add_argument("--min-score", type=float, default=MIN_RELEVANCE_SCORE,
+                        help="Minimum relevance score (0-1) for a chunk to be used as context.")
     args = parser.parse_args()
     query_text = args.query_text
-    query_rag(query_text)
 
+    filters = {"source": args.source, "page": args.page, "chunk_type": args.chunk_type}
+    for item in args.filter:
+        key, _, value = item.partition("=")
+        filters[key] = int(value) if value.lstrip("-").isdigit() else value
+    query_rag(query_text, filters=filters, min_score=args.min_score)
 
-def query_rag(query_text: str):
-    # Prepare the DB.
-    embedding_function = get_embedding_function()
-    db = Chroma(persist_directory=CHROMA_PATH, embedding_function=embedding_function)
 
-    # Search the DB.
-    results = db.similarity_search_with_score(query_text, k=5)
+def build_metadata_filter(filters: dict = None):
+    """
+    Translate query-time filters into a Chroma ``where`` clause.
 
-    context_text = "\n\n---\n\n".join([doc.page_content for doc, _score in results])
-    prompt_template = ChatPromptTemplate.from_template(PROMPT_TEMPLATE)
-    prompt = prompt_template.format(context=context_text, question=query_text)
-    # print(prompt)
+    Supported filters:
+        source: a file name (matched against the indexed ``source_name``) or a
+            path; indexed sources are absolute, so relative paths are resolved
+            against the working directory
+        page: a page number, a [start, end] pair or a "start-end" string
+        any other metadata key: a value for exact match, a list for any-of, or a
+            dict of Chroma operators such as {"$gte": 3}
+
+    Returns None when there is nothing to filter on.
+    """
+    conditions = []
+    for key, value in (filters or {}).items():
+        if value is None or value == "" or value == []:
+            continue
+
+        if key == "source" and isinstance(value, str):
+            if os.path.basename(value) == value:
+                key = "source_name"
+            else:
+                value = os.path.abspath(value)
+
+        if key == "page" and not isinstance(value, dict):
+            if isinstance(value, str) and "-" in value.strip("-"):
+                value = value.split("-", 1)
+            if isinstance(value, (list, tuple)):
+                start, end = (int(v) for v in value)
+                conditions.append({"page": {"$gte": start}})
+                conditions.append({"page": {"$lte": end}})
+                continue
+            value = int(value)
+
+        if isinstance(value, dict):
+            conditions.append({key: value})
+        elif isinstance(value, (list, tuple)):
+            conditions.append({key: {"$in": list(value)}})
+        else:
+            conditions.append({key: {"$eq": value}})
+
+    if not conditions:
+        return None
+    if len(conditions) == 1:
+        return conditions[0]
+    return {"$and": conditions}
+
+
+def select_relevant(results, min_score: float = MIN_RELEVANCE_SCORE):
+    """
+    Keep the (document, relevance score) pairs worth sending to the LLM.
+
+    Results must be sorted best first. Returns the kept pairs and, when none
+    pass ``min_score``, the reason why.
+    """
+    relevant = [(doc, score) for doc, score in results if score >= min_score]
+    if not relevant:
+        if not results:
+            return [], "No matching documents were found in the database."
+        best_score = max(score for _doc, score in results)
+        return [], (f"No sufficiently relevant context found "
+                    f"(best relevance {best_score:.2f} < threshold {min_score:.2f}).")
+
+    # A strong top hit needs less supporting context.
+    if relevant[0][1] >= STRONG_RELEVANCE_SCORE:
+        relevant = relevant[:STRONG_MATCH_K]
+    return relevant, None
+
+
+def query_rag(query_text: str, chroma_path: str = CHROMA_PATH, filters: dict = None,
+              min_score: float = MIN_RELEVANCE_SCORE):
+    # Search the DB, letting Chroma apply the metadata filter during the search.
+    results = retrieve(query_text, chroma_path=chroma_path, filters=filters)
+    results, reason = select_relevant(results, min_score)
+
+    # Nothing relevant: answer straight away instead of paying for a generation.
+    if not results:
+        formatted_response = f"Response: {reason}\nSources: []"
+        print(formatted_response)
+        return formatted_response
+
+    prompt = build_prompt(query_text, results)
 
     model = OllamaLLM(model=LLM_TO_USE)
     response_text = model.invoke(prompt)
 
-    sources = [doc.metadata.get("id", None) for doc, _score in results]
-    formatted_response = f"Response: {response_text}\nSources: {sources}"
+    formatted_response = format_response(response_text, results)
     print(formatted_response)
     return formatted_response  # Return the full formatted response instead of just response_text
 
+
+async def aquery_rag(query_text: str, chroma_path: str = CHROMA_PATH, filters: dict = None,
+                     min_score: float = MIN_RELEVANCE_SCORE):
+    """
+    Async version of query_rag for the web API.
+
+    The query embedding and the generation are awaited over Ollama's async HTTP
+    client, and the vector search runs on a shared thread pool, so many
+    questions can be in flight while Ollama works.
+    """
+    results = await aretrieve(query_text, chroma_path=chroma_path, filters=filters)
+    results, reason = select_relevant(results, min_score)
+
+    # Nothing relevant: answer straight away instead of paying for a generation.
+    if not results:
+        return f"Response: {reason}\nSources: []"
+
+    prompt = build_prompt(query_text, results)
+
+    model = OllamaLLM(model=LLM_TO_USE)
+    response_text = await model.ainvoke(prompt)
+
+    return format_response(response_text, results)
+
+
+def retrieve(query_text: str, chroma_path: str = CHROMA_PATH, filters: dict = None, k: int = MAX_K):
+    """
+    Return the best ``k`` (document, relevance score) pairs for the query.
+
+    A sharded database is searched shard by shard in parallel and the hits
+    are merged by score.
+    """
+    embedding_function = get_embedding_function()
+    dbs = load_databases(chroma_path, embedding_function)
+    query_embedding = embedding_function.embed_query(query_text)
+    where = build_metadata_filter(filters)
+
+    if len(dbs) == 1:
+        return search_database(dbs[0], query_embedding, k, where)
+    shard_results = _search_executor.map(
+        lambda db: search_database(db, query_embedding, k, where), dbs
+    )
+    return merge_results(shard_results, k)
+
+
+async def aretrieve(query_text: str, chroma_path: str = CHROMA_PATH, filters: dict = None, k: int = MAX_K):
+    """Async version of retrieve: the embedding is awaited and every search runs off the event loop."""
+    embedding_function = get_embedding_function()
+    loop = asyncio.get_running_loop()
+    # Opening a Chroma client touches SQLite, so it stays off the event loop too.
+    dbs = await loop.run_in_executor(_search_executor, load_databases, chroma_path, embedding_function)
+    query_embedding = await embedding_function.aembed_query(query_text)
+    where = build_metadata_filter(filters)
+
+    shard_results = await asyncio.gather(*[
+        loop.run_in_executor(_search_executor, search_database, db, query_embedding, k, where)
+        for db in dbs
+    ])
+    return merge_results(shard_results, k)
+
+
+def load_databases(chroma_path: str, embedding_function):
+    """One Chroma instance per shard of ``chroma_path``, or just the database itself."""
+    with profile_worker():
+        return [get_database(path, embedding_function) for path in shard_paths(chroma_path)]
+
+
+def search_database(db, query_embedding, k: int, where):
+    with profile_worker():
+        results = db.similarity_search_by_vector_with_relevance_scores(query_embedding, k=k, filter=where)
+    # The by-vector search returns raw distances; normalise them the same
+    # way similarity_search_with_relevance_scores does.
+    relevance_score_fn = db._select_relevance_score_fn()
+    return [(doc, relevance_score_fn(distance)) for doc, distance in results]
+
+
+def merge_results(shard_results, k: int):
+    merged = [hit for hits in shard_results for hit in hits]
+    merged.sort(key=lambda hit: hit[1], reverse=True)
+    return merged[:k]
+
+
+def build_prompt(query_text: str, results) -> str:
+    context_text = "\n\n---\n\n".join([doc.page_content for doc, _score in results])
+    prompt_template = ChatPromptTemplate.from_template(PROMPT_TEMPLATE)
+    return prompt_template.format(context=context_text, question=query_text)
+
+
+def format_response(response_text: str, results) -> str:
+    sources = [doc.metadata.get("id", None) for doc, _score in results]
+    return f"Response: {response_text}\nSources: {sources}"
+
 if __name__ == "__main__":
     main()
@@ -2,6 +2,7 @@ from sklearn.cluster import KMeans
 from sklearn.feature_extraction.text import TfidfVectorizer
 from sklearn.exceptions import ConvergenceWarning
 from langchain.schema.document import Document
+from chunks import Chunk, to_documents
 import numpy as np
 from typing import List
 import re
@@ -133,6 +134,10 @@ class SemanticChunker:
 
     def split_documents(self, documents: List[Document]) -> List[Document]:
         """Enhanced document splitting with detailed logging"""
+        return to_documents(self.split_chunks(documents))
+
+    def split_chunks(self, documents: List[Document]) -> List[Chunk]:
+        """Split documents into Chunk records that share each page's metadata"""
         all_chunks = []
         total_docs = len(documents)
 
@@ -159,34 +164,29 @@ class SemanticChunker:
                         chunks = [self._clean_pdf_text(doc.page_content)]
                         self.logger.info("Using entire document as one chunk")
 
+                total_chunks = len(chunks)
+                original_length = len(doc.page_content)
                 for chunk_idx, chunk in enumerate(chunks):
-                    chunk_doc = Document(
-                        page_content=chunk,
-                        metadata={
-                            **doc.metadata,
-                            'chunk_type': 'semantic',
-                            'chunk_index': chunk_idx,
-                            'total_chunks': len(chunks),
-                            'original_length': len(doc.page_content),
-                            'chunk_length': len(chunk)
-                        }
-                    )
-                    all_chunks.append(chunk_doc)
+                    all_chunks.append(Chunk(
+                        chunk,
+                        doc.metadata,
+                        chunk_type='semantic',
+                        chunk_index=chunk_idx,
+                        total_chunks=total_chunks,
+                        original_length=original_length
+                    ))
 
                 self.logger.info(f"Created {len(chunks)} chunks for document {idx}")
 
             except Exception as e:
                 self.logger.error(f"Error processing document {idx}: {str(e)}")
                 # Store entire document as one chunk in case of error
-                chunk_doc = Document(
-                    page_content=self._clean_pdf_text(doc.page_content),
-                    metadata={
-                        **doc.metadata,
-                        'chunk_type': 'error_fallback',
-                        'error': str(e)
-                    }
-                )
-                all_chunks.append(chunk_doc)
+                all_chunks.append(Chunk(
+                    self._clean_pdf_text(doc.page_content),
+                    doc.metadata,
+                    chunk_type='error_fallback',
+                    error=str(e)
+                ))
 
         self.logger.info(f"Total chunks created: {len(all_chunks)}")
         return all_chunks
@@ -0,0 +1,51 @@
+import hashlib
+import json
+import os
+
+"""
+Shard layout for databases ingested in parallel
+
+A sharded database is a directory holding one Chroma database per shard
+(shard-00, shard-01, ...) and a shards.json manifest listing them. Every
+source file always lands in the same shard, chosen from a hash of its path.
+"""
+
+SHARD_MANIFEST = "shards.json"
+
+
+def shard_for_source(source: str, num_shards: int) -> int:
+    digest = hashlib.sha1(source.encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "big") % num_shards
+
+
+def shard_name(index: int) -> str:
+    return f"shard-{index:02d}"
+
+
+def read_shard_manifest(chroma_path: str):
+    """Return the manifest of a sharded database, or None for a plain one."""
+    manifest_path = os.path.join(chroma_path, SHARD_MANIFEST)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, "r") as f:
+        return json.load(f)
+
+
+def write_shard_manifest(chroma_path: str, num_shards: int) -> dict:
+    manifest = {
+        "num_shards": num_shards,
+        "hash": "sha1",
+        "shards": [shard_name(i) for i in range(num_shards)],
+    }
+    os.makedirs(chroma_path, exist_ok=True)
+    with open(os.path.join(chroma_path, SHARD_MANIFEST), "w") as f:
+        json.dump(manifest, f, indent=2)
+    return manifest
+
+
+def shard_paths(chroma_path: str) -> list[str]:
+    """Database directories to search: every shard, or the database itself."""
+    manifest = read_shard_manifest(chroma_path)
+    if manifest is None:
+        return [chroma_path]
+    return [os.path.join(chroma_path, shard) for shard in manifest["shards"]]
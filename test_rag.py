@@ -1,7 +1,28 @@
-from query_data import query_rag
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from query_data import query_rag, retrieve, merge_results, build_metadata_filter, select_relevant, CHROMA_PATH
 # from langchain_community.llms.ollama import Ollama
 from langchain_ollama import OllamaLLM
 
+from get_embedding_function import MicroBatchingEmbeddings
+from langchain.schema.document import Document
+import populate_database
+from populate_database import split_chunks, split_documents, calculate_chunk_ids, add_documents_to_chroma
+from profiling import profile_run, profile_worker
+from shards import shard_for_source
+from main import ResponseCache
+
+EVAL_DATASET_PATH = "eval_dataset.json"
+JUDGE_CACHE_PATH = os.path.join(".eval_cache", "judge_verdicts.json")
+JUDGE_MODEL = "mistral"
+
 EVAL_PROMPT = """
 Expected Response: {expected_response}
 Actual Response: {actual_response}
@@ -24,27 +45,667 @@ def test_ticket_to_ride_rules():
     )
 
 
-def query_and_validate(question: str, expected_response: str):
-    response_text = query_rag(question)
+def test_retrieval_metrics():
+    retrieved = [
+        {"id": "data/catan.pdf:2:0", "source": "data/catan.pdf", "page": 2},
+        {"id": "data/monopoly.pdf:6:1", "source": "data/monopoly.pdf", "page": 6},
+        {"id": "data/monopoly.pdf:7:0", "source": "data/monopoly.pdf", "page": 7},
+    ]
+    assert recall_at_k(retrieved, ["monopoly.pdf:6"], k=1) == 0.0
+    assert recall_at_k(retrieved, ["monopoly.pdf:6"], k=3) == 1.0
+    assert recall_at_k(retrieved, ["monopoly.pdf", "ticket_to_ride.pdf"], k=3) == 0.5
+    assert reciprocal_rank(retrieved, ["data/monopoly.pdf:7:0"]) == 1 / 3
+    assert reciprocal_rank(retrieved, ["ticket_to_ride.pdf"]) == 0.0
+
+
+def test_build_metadata_filter():
+    assert build_metadata_filter(None) is None
+    assert build_metadata_filter({"source": "", "page": None}) is None
+    assert build_metadata_filter({"source": "monopoly.pdf"}) == {"source_name": {"$eq": "monopoly.pdf"}}
+    assert build_metadata_filter({"source": "data/monopoly.pdf", "page": "6-8"}) == {"$and": [
+        {"source": {"$eq": os.path.abspath("data/monopoly.pdf")}},
+        {"page": {"$gte": 6}},
+        {"page": {"$lte": 8}},
+    ]}
+    assert build_metadata_filter({"source": "/docs/monopoly.pdf"}) == {"source": {"$eq": "/docs/monopoly.pdf"}}
+    assert build_metadata_filter({"chunk_type": ["semantic", "error_fallback"]}) == {
+        "chunk_type": {"$in": ["semantic", "error_fallback"]}
+    }
+
+
+def test_select_relevant():
+    relevant, reason = select_relevant([("a", 0.3), ("b", 0.2)], min_score=0.4)
+    assert relevant == [] and "0.30" in reason
+    relevant, reason = select_relevant([("a", 0.6), ("b", 0.5), ("c", 0.3)], min_score=0.4)
+    assert relevant == [("a", 0.6), ("b", 0.5)] and reason is None
+    relevant, _reason = select_relevant([("a", 0.9), ("b", 0.85), ("c", 0.8), ("d", 0.7)], min_score=0.4)
+    assert [doc for doc, _score in relevant] == ["a", "b"]
+
+
+def test_chunk_records_share_page_metadata(monkeypatch):
+    page = Document(page_content="word " * 400, metadata={"source": "data/monopoly.pdf", "page": 6})
+    chunks = calculate_chunk_ids(split_chunks([page], chunk_size=500, chunk_overlap=0))
+    assert len(chunks) > 1
+    assert all(chunk.page_metadata is page.metadata for chunk in chunks)
+    assert [chunk.id for chunk in chunks[:2]] == ["data/monopoly.pdf:6:0", "data/monopoly.pdf:6:1"]
+
+    document = chunks[1].to_document()
+    assert document.metadata == {"source": "data/monopoly.pdf", "page": 6,
+                                 "id": "data/monopoly.pdf:6:1", "source_name": "monopoly.pdf"}
+    assert page.metadata == {"source": "data/monopoly.pdf", "page": 6}
+
+    # Documents from split_documents are still accepted.
+    documents = calculate_chunk_ids(split_documents([page], chunk_size=500, chunk_overlap=0))
+    assert [doc.metadata["id"] for doc in documents[:2]] == ["data/monopoly.pdf:6:0", "data/monopoly.pdf:6:1"]
+
+    class RecordingDatabase:
+        def get(self, include=None):
+            return {"ids": ["data/monopoly.pdf:6:0"]}
+
+        def __init__(self):
+            self.added = []
+
+        def add_documents(self, documents, ids):
+            self.added.append((documents, ids))
+
+    monkeypatch.setattr(populate_database, "CHROMA_WRITE_BATCH_SIZE", 2)
+    db = RecordingDatabase()
+    added_ids = add_documents_to_chroma(documents, db)
+    assert added_ids == [doc.metadata["id"] for doc in documents[1:]]
+    assert [ids for _documents, ids in db.added] == [added_ids[i:i + 2] for i in range(0, len(added_ids), 2)]
+    assert db.added[0][0][0].metadata["source_name"] == "monopoly.pdf"
+
+
+def test_micro_batching_embeddings():
+    class RecordingEmbeddings:
+        def __init__(self):
+            self.calls = []
+
+        def embed_documents(self, texts):
+            self.calls.append(len(texts))
+            time.sleep(0.01)
+            return [[float(len(text))] for text in texts]
+
+    inner = RecordingEmbeddings()
+    embeddings = MicroBatchingEmbeddings(inner, max_wait_ms=20, max_batch_size=8)
+    texts = ["x" * n for n in range(1, 33)]
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        vectors = list(executor.map(embeddings.embed_query, texts))
+
+    assert vectors == [[float(n)] for n in range(1, 33)]
+    assert sum(inner.calls) == 32 and len(inner.calls) < 32
+    metrics = embeddings.metrics()
+    assert metrics["requests"] == 32 and metrics["largest_batch"] <= 8
+
+    class BrokenEmbeddings:
+        def embed_documents(self, texts):
+            if texts == ["hang"]:
+                time.sleep(0.5)
+            return [[0.0]] * (len(texts) - 1)
+
+    embeddings = MicroBatchingEmbeddings(BrokenEmbeddings(), max_wait_ms=1, timeout=0.1)
+    for text, expected_error in (("short", RuntimeError), ("hang", TimeoutError)):
+        try:
+            embeddings.embed_query(text)
+        except expected_error:
+            pass
+        else:
+            raise AssertionError(f"embed_query({text!r}) should raise {expected_error.__name__}")
+
+    class SlowEmbeddings:
+        def embed_documents(self, texts):
+            time.sleep(0.2)
+            return [[float(len(text))] for text in texts]
+
+    async def cancel_callers():
+        embeddings = MicroBatchingEmbeddings(SlowEmbeddings(), max_wait_ms=20, timeout=2)
+        blocking = asyncio.ensure_future(embeddings.aembed_query("block"))
+        await asyncio.sleep(0.05)
+
+        # Cancelled while queued behind the running batch.
+        cancelled = asyncio.ensure_future(embeddings.aembed_query("a"))
+        live = asyncio.ensure_future(embeddings.aembed_query("bbb"))
+        await asyncio.sleep(0.01)
+        cancelled.cancel()
+        assert await live == [3.0] and await blocking == [5.0]
+
+        # Cancelled while its batch is being embedded.
+        cancelled = asyncio.ensure_future(embeddings.aembed_query("cc"))
+        live = asyncio.ensure_future(embeddings.aembed_query("dddd"))
+        await asyncio.sleep(0.1)
+        cancelled.cancel()
+        assert await live == [4.0]
+        assert await embeddings.aembed_query("e") == [1.0]
+
+    asyncio.run(cancel_callers())
+
+
+def test_sharding_and_merge():
+    assert shard_for_source("/data/monopoly.pdf", 4) == shard_for_source("/data/monopoly.pdf", 4)
+    assert {shard_for_source(f"/data/manual_{i}.pdf", 4) for i in range(50)} == {0, 1, 2, 3}
+    merged = merge_results([[("a", 0.9), ("c", 0.5)], [("b", 0.7)], []], k=2)
+    assert merged == [("a", 0.9), ("b", 0.7)]
+
+
+def test_sharded_ingest_and_retrieve(tmp_path, monkeypatch):
+    import query_data
+    from langchain_core.embeddings import DeterministicFakeEmbedding
+    from get_database import get_database
+    from populate_database import ingest_sharded, get_database_for_source
+    from query_data import aretrieve
+    from shards import read_shard_manifest
+
+    class InProcessExecutor(ThreadPoolExecutor):
+        # Spawned workers would not see the fakes below.
+        def __init__(self, max_workers=None, mp_context=None):
+            super().__init__(max_workers=max_workers)
+
+    def load_document(path):
+        return [Document(page_content=f"contents of {os.path.basename(path)}", metadata={"source": path, "page": 0})]
+
+    embeddings = DeterministicFakeEmbedding(size=16)
+    monkeypatch.setattr("get_database.get_embedding_function", lambda: embeddings)
+    monkeypatch.setattr(query_data, "get_embedding_function", lambda: embeddings)
+    monkeypatch.setattr(populate_database, "load_document", load_document)
+    monkeypatch.setattr(populate_database, "ProcessPoolExecutor", InProcessExecutor)
+
+    data_path = tmp_path / "data"
+    data_path.mkdir()
+    for i in range(6):
+        (data_path / f"manual_{i}.pdf").write_text("")
+    sources = populate_database.list_documents(str(data_path))
+    assert {shard_for_source(source, 2) for source in sources} == {0, 1}
+
+    chroma_path = str(tmp_path / "chroma")
+    assert ingest_sharded(str(data_path), chroma_path, 2) == 6
+    assert read_shard_manifest(chroma_path)["shards"] == ["shard-00", "shard-01"]
+    assert ingest_sharded(str(data_path), chroma_path, 2) == 0
+    plain_path = str(tmp_path / "plain")
+    get_database(plain_path, embeddings)
+    for wrong_target, num_shards in ((chroma_path, 3), (plain_path, 2)):
+        try:
+            ingest_sharded(str(data_path), wrong_target, num_shards)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError(f"ingest_sharded({wrong_target!r}, {num_shards}) should raise ValueError")
+
+    for source in sources:
+        db = get_database_for_source(chroma_path, source)
+        assert db.get(where={"source": source}, include=[])["ids"] == [f"{source}:0:0"]
+        other_shard = get_database(os.path.join(chroma_path, f"shard-{1 - shard_for_source(source, 2):02d}"), embeddings)
+        assert other_shard.get(where={"source": source}, include=[])["ids"] == []
+
+        query = f"contents of {os.path.basename(source)}"
+        results = retrieve(query, chroma_path=chroma_path, k=3)
+        assert len(results) == 3
+        assert results[0][0].metadata["id"] == f"{source}:0:0" and results[0][1] > 0.99
+        async_results = asyncio.run(aretrieve(query, chroma_path=chroma_path, k=3))
+        assert [doc.metadata["id"] for doc, _score in async_results] == [doc.metadata["id"] for doc, _score in results]
+
+
+def test_response_cache_eviction(tmp_path):
+    cache = ResponseCache(str(tmp_path), max_bytes=1500)
+    options = {"seed": 42, "temperature": 0}
+    keys = [cache.key("sha256:abc", f"prompt {i}", None, options) for i in range(3)]
+    assert len(set(keys)) == 3
+    assert cache.key("sha256:def", "prompt 0", None, options) != keys[0]
+
+    for i, key in enumerate(keys):
+        cache.put(key, "x" * 600, "llama2")
+        os.utime(cache._path(key), (i, i))
+    cache.put(keys[2], "x" * 600, "llama2")
+    assert cache.get(keys[0]) is None
+    assert cache.get(keys[1]) == "x" * 600 and cache.get(keys[2]) == "x" * 600
+
+    cache.remember_digest("llama2", "sha256:abc")
+    assert cache.known_digest("llama2") == "sha256:abc"
+
+    # A models.json truncated by an interrupted run is treated as empty.
+    with open(cache.models_path, "w") as f:
+        f.write('{"llama2": "sha')
+    assert cache.known_digest("llama2") is None
+    cache.remember_digest("mistral", "sha256:def")
+    assert cache.known_digest("mistral") == "sha256:def"
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".tmp")]
+
+
+def test_deterministic_main_serves_repeat_from_cache(tmp_path, monkeypatch, capsys):
+    import sys
+    import main as cli
+
+    class Response:
+        def __init__(self, payload):
+            self.status_code = 200
+            self.text = json.dumps(payload)
+            self._payload = payload
+
+        def json(self):
+            return self._payload
+
+    calls = []
+
+    def fake_get(url, **kwargs):
+        calls.append(url)
+        return Response({"models": [{"name": "llama2:latest", "digest": "sha256:abc"}]})
+
+    def fake_post(url, json=None, **kwargs):
+        calls.append(url)
+        return Response({"response": f"answer with seed {json['options']['seed']}"})
+
+    def unreachable(url, **kwargs):
+        raise AssertionError(f"cache hit should not call Ollama, got {url}")
+
+    argv = ["main.py", "--model", "llama2", "--query", "hi", "--deterministic",
+            "--cache-dir", str(tmp_path)]
+    monkeypatch.setattr(sys, "argv", argv)
+    monkeypatch.setattr(cli.requests, "get", fake_get)
+    monkeypatch.setattr(cli.requests, "post", fake_post)
+    cli.main()
+    assert any(url.endswith("/api/tags") for url in calls)
+    assert "answer with seed 42" in capsys.readouterr().out
+
+    monkeypatch.setattr(cli.requests, "get", unreachable)
+    monkeypatch.setattr(cli.requests, "post", unreachable)
+    cli.main()
+    assert "answer with seed 42" in capsys.readouterr().out
+
+
+def test_suggest_min_score():
+    assert suggest_min_score([0.62, 0.71], [0.28, 0.41]) == (0.62 + 0.41) / 2
+    assert suggest_min_score([0.62], []) is None
+
+
+def test_upload_replaces_document_chunks(tmp_path, monkeypatch):
+    import io
+    from langchain_core.embeddings import DeterministicFakeEmbedding
+    from app import app as flask_app, config
+    from get_database import get_database
+
+    # The fake "PDF" holds a version label and a page count.
+    def load_document(path):
+        with open(path) as f:
+            version, num_pages = f.read().split()
+        return [Document(page_content=f"{version} text of page {page}", metadata={"source": path, "page": page})
+                for page in range(int(num_pages))]
+
+    class FlakyEmbeddings(DeterministicFakeEmbedding):
+        def embed_documents(self, texts):
+            if any(text.startswith("broken") for text in texts):
+                raise RuntimeError("embedding service unavailable")
+            return super().embed_documents(texts)
+
+    embeddings = FlakyEmbeddings(size=16)
+    monkeypatch.setattr("get_database.get_embedding_function", lambda: embeddings)
+    monkeypatch.setattr(populate_database, "load_document", load_document)
+    monkeypatch.setitem(config, "DATA_PATH", str(tmp_path / "data"))
+    monkeypatch.setitem(config, "CHROMA_PATH", str(tmp_path / "chroma"))
+    document_path = str(tmp_path / "data" / "manual.pdf")
+    client = flask_app.test_client()
+
+    def upload(content):
+        return client.post("/api/upload_document", content_type="multipart/form-data",
+                           data={"file": (io.BytesIO(content), "manual.pdf")})
+
+    def indexed():
+        stored = get_database(config["CHROMA_PATH"], embeddings).get(where={"source": document_path})
+        return sorted(zip(stored["ids"], stored["documents"]))
+
+    assert upload(b"first 3").get_json()["num_chunks"] == 3
+    assert [text for _id, text in indexed()] == [f"first text of page {page}" for page in range(3)]
+
+    # A shorter new version overwrites page 0 and drops pages 1 and 2.
+    assert upload(b"second 1").get_json()["chunk_ids"] == [f"{document_path}:0:0"]
+    assert indexed() == [(f"{document_path}:0:0", "second text of page 0")]
+
+    # A failed re-index leaves both the file and its chunks as they were.
+    assert upload(b"broken 1").status_code == 500
+    assert indexed() == [(f"{document_path}:0:0", "second text of page 0")]
+    with open(document_path) as f:
+        assert f.read() == "second 1"
+    assert os.listdir(tmp_path / "data") == ["manual.pdf"]
+
+
+def test_asgi_query_holds_many_questions_in_flight(monkeypatch):
+    import httpx
+    import query_data
+    from asgi import application
+
+    class SlowLLM:
+        def __init__(self, model):
+            pass
+
+        async def ainvoke(self, prompt):
+            await asyncio.sleep(0.5)
+            return "answer"
+
+    async def fake_retrieve(query_text, chroma_path=CHROMA_PATH, filters=None, k=5):
+        return [(Document(page_content="context", metadata={"id": "data/monopoly.pdf:6:0"}), 0.9)]
+
+    monkeypatch.setattr(query_data, "OllamaLLM", SlowLLM)
+    monkeypatch.setattr(query_data, "aretrieve", fake_retrieve)
+
+    async def ask_many(n):
+        transport = httpx.ASGITransport(app=application)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await asyncio.gather(*[
+                client.post("/api/query", json={"question": f"q{i}"}) for i in range(n)
+            ])
+
+    start = time.perf_counter()
+    responses = asyncio.run(ask_many(200))
+    elapsed = time.perf_counter() - start
+
+    assert all(r.status_code == 200 and r.json()["response"].startswith("Response: answer") for r in responses)
+    # 200 generations of 0.5s each complete together, not one per worker thread.
+    assert elapsed < 5
+
+
+def test_judge_cache_round_trip(tmp_path):
+    cache_path = tmp_path / "verdicts.json"
+    cache = JudgeCache(str(cache_path))
+    key = cache.key(JUDGE_MODEL, "prompt")
+    assert cache.get(key) is None
+    cache.put(key, True)
+    cache.save()
+    assert JudgeCache(str(cache_path)).get(key) is True
+
+
+def test_profile_run_writes_report(tmp_path):
+    with profile_run("unit", output_dir=str(tmp_path)) as report_path:
+        [str(i) for i in range(10000)]
+    with open(report_path) as f:
+        report = f.read()
+    assert "allocation sites" in report and "cumulative time" in report
+    assert os.path.exists(report_path.replace(".txt", ".prof"))
+
+    with profile_run("unit", enabled=False, output_dir=str(tmp_path)) as report_path:
+        pass
+    assert report_path is None
+
+    def build_strings():
+        return sorted(str(i) for i in range(10000))
+
+    def profiled_on_worker():
+        with profile_worker():
+            return build_strings()
+
+    with profile_run("unit", output_dir=str(tmp_path)) as report_path:
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            executor.submit(profiled_on_worker).result()
+    with open(report_path) as f:
+        report = f.read()
+    assert "1 worker tasks" in report and "build_strings" in report
+
+    armed = {"unit"}
+
+    def claim():
+        # Consumes the arm like app.should_profile.
+        was_armed = "unit" in armed
+        armed.discard("unit")
+        return was_armed
+
+    with profile_run("busy", output_dir=str(tmp_path)):
+        with profile_run("unit", enabled=claim, output_dir=str(tmp_path)) as report_path:
+            assert report_path is None
+    assert armed == {"unit"}
+    with profile_run("unit", enabled=claim, output_dir=str(tmp_path)) as report_path:
+        assert report_path is not None
+    assert armed == set()
+
+
+class JudgeCache:
+    """Judge verdicts stored on disk, keyed by judge model and prompt."""
+
+    def __init__(self, path: str = JUDGE_CACHE_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self._verdicts = {}
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                self._verdicts = json.load(f)
+
+    @staticmethod
+    def key(model: str, prompt: str) -> str:
+        return hashlib.sha256(f"{model}\0{prompt}".encode("utf-8")).hexdigest()
+
+    def get(self, key: str):
+        with self._lock:
+            return self._verdicts.get(key)
+
+    def put(self, key: str, verdict: bool):
+        with self._lock:
+            self._verdicts[key] = verdict
+
+    def save(self):
+        with self._lock:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(self.path, "w") as f:
+                json.dump(self._verdicts, f, indent=2)
+
+
+judge_cache = JudgeCache()
+
+
+def query_and_validate(question: str, expected_response: str, chroma_path: str = CHROMA_PATH):
+    response_text = query_rag(question, chroma_path=chroma_path)
+    return judge_response(expected_response, response_text)
+
+
+def judge_response(expected_response: str, actual_response: str, cache: JudgeCache = judge_cache):
     prompt = EVAL_PROMPT.format(
-        expected_response=expected_response, actual_response=response_text
+        expected_response=expected_response, actual_response=actual_response
     )
 
-    model = OllamaLLM(model="mistral")
+    print(prompt)
+
+    cache_key = cache.key(JUDGE_MODEL, prompt)
+    verdict = cache.get(cache_key)
+    if verdict is not None:
+        print(f"Cached verdict: {verdict}")
+        return verdict
+
+    model = OllamaLLM(model=JUDGE_MODEL)
     evaluation_results_str = model.invoke(prompt)
     evaluation_results_str_cleaned = evaluation_results_str.strip().lower()
 
-    print(prompt)
-
     if "true" in evaluation_results_str_cleaned:
         # Print response in Green if it is correct.
         print("\033[92m" + f"Response: {evaluation_results_str_cleaned}" + "\033[0m")
-        return True
+        verdict = True
     elif "false" in evaluation_results_str_cleaned:
         # Print response in Red if it is incorrect.
         print("\033[91m" + f"Response: {evaluation_results_str_cleaned}" + "\033[0m")
-        return False
+        verdict = False
     else:
         raise ValueError(
             f"Invalid evaluation result. Cannot determine if 'true' or 'false'."
         )
+
+    cache.put(cache_key, verdict)
+    cache.save()
+    return verdict
+
+
+def load_eval_dataset(path: str = EVAL_DATASET_PATH):
+    """
+    Load labeled evaluation cases.
+
+    Each case is a dict with a "question", a list of "expected_sources" and an
+    optional "expected_response" used by the LLM-judged end-to-end run.
+    Expected sources may be a file name ("monopoly.pdf"), a file and page
+    ("monopoly.pdf:6"), a full source path or a full chunk ID.
+    """
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def source_matches(metadata: dict, expected_source: str) -> bool:
+    source = metadata.get("source") or ""
+    page = metadata.get("page")
+    name = os.path.basename(source)
+    return expected_source in (
+        metadata.get("id"),
+        source,
+        name,
+        f"{source}:{page}",
+        f"{name}:{page}",
+    )
+
+
+def recall_at_k(retrieved: list[dict], expected_sources: list[str], k: int) -> float:
+    """Fraction of the expected sources found in the top ``k`` results."""
+    if not expected_sources:
+        return 0.0
+    top_k = retrieved[:k]
+    found = sum(
+        1 for expected in expected_sources
+        if any(source_matches(metadata, expected) for metadata in top_k)
+    )
+    return found / len(expected_sources)
+
+
+def reciprocal_rank(retrieved: list[dict], expected_sources: list[str]) -> float:
+    """1 / rank of the first result matching any expected source."""
+    for rank, metadata in enumerate(retrieved, 1):
+        if any(source_matches(metadata, expected) for expected in expected_sources):
+            return 1.0 / rank
+    return 0.0
+
+
+def evaluate_retrieval(cases: list[dict], chroma_path: str = CHROMA_PATH, ks=(1, 3, 5)):
+    """
+    Compute recall@k and MRR over the cases using vector search only (no LLM).
+
+    Cases with an empty "expected_sources" list are off-topic questions. They
+    are left out of recall and MRR and only used, together with the score of
+    the best matching result of every on-topic case, to calibrate min_score.
+    """
+    max_k = max(ks)
+
+    recalls = {k: [] for k in ks}
+    reciprocal_ranks = []
+    latencies = []
+    relevant_scores = []
+    off_topic_scores = []
+    for case in cases:
+        start = time.perf_counter()
+        results = retrieve(case["question"], chroma_path=chroma_path, k=max_k)
+        latencies.append(time.perf_counter() - start)
+
+        expected_sources = case.get("expected_sources", [])
+        if not expected_sources:
+            if results:
+                off_topic_scores.append(results[0][1])
+            continue
+
+        retrieved = [doc.metadata for doc, _score in results]
+        for k in ks:
+            recalls[k].append(recall_at_k(retrieved, expected_sources, k))
+        reciprocal_ranks.append(reciprocal_rank(retrieved, expected_sources))
+        matching_scores = [score for doc, score in results
+                           if any(source_matches(doc.metadata, expected) for expected in expected_sources)]
+        if matching_scores:
+            relevant_scores.append(max(matching_scores))
+
+    num_on_topic = len(reciprocal_ranks) or 1
+    return {
+        "chroma_path": chroma_path,
+        "num_cases": len(cases),
+        "recall": {k: sum(values) / num_on_topic for k, values in recalls.items()},
+        "mrr": sum(reciprocal_ranks) / num_on_topic,
+        "retrieval_ms": 1000 * sum(latencies) / (len(cases) or 1),
+        "min_relevant_score": min(relevant_scores) if relevant_scores else None,
+        "max_off_topic_score": max(off_topic_scores) if off_topic_scores else None,
+        "suggested_min_score": suggest_min_score(relevant_scores, off_topic_scores),
+    }
+
+
+def suggest_min_score(relevant_scores: list[float], off_topic_scores: list[float]):
+    """
+    Midpoint between the best off-topic hit and the weakest relevant hit.
+
+    If the two ranges overlap no threshold separates them cleanly and the
+    midpoint trades some recall for fewer wasted generations.
+    """
+    if not relevant_scores or not off_topic_scores:
+        return None
+    return (min(relevant_scores) + max(off_topic_scores)) / 2
+
+
+def evaluate_end_to_end(cases: list[dict], chroma_path: str = CHROMA_PATH, max_workers: int = 4):
+    """Run the LLM-judged cases concurrently; judge verdicts come from the cache when possible."""
+    cases = [case for case in cases if case.get("expected_response")]
+
+    def run_case(case):
+        start = time.perf_counter()
+        try:
+            passed = query_and_validate(case["question"], case["expected_response"],
+                                        chroma_path=chroma_path)
+        except ValueError as e:
+            print(f"Error judging {case['question']!r}: {e}")
+            passed = False
+        return passed, time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(run_case, cases))
+
+    num_cases = len(cases) or 1
+    return {
+        "num_judged": len(cases),
+        "accuracy": sum(passed for passed, _elapsed in results) / num_cases,
+        "end_to_end_s": sum(elapsed for _passed, elapsed in results) / num_cases,
+    }
+
+
+def print_report(reports: list[dict], ks):
+    columns = ["database", "cases"] + [f"recall@{k}" for k in ks] + ["MRR", "search ms",
+                                                                     "min relevant", "max off-topic",
+                                                                     "suggested min_score"]
+    judged = any("accuracy" in report for report in reports)
+    if judged:
+        columns += ["judged", "accuracy", "e2e s"]
+    print(" | ".join(columns))
+    print("-" * (len(" | ".join(columns)) + 10))
+    for report in reports:
+        row = [report["chroma_path"], str(report["num_cases"])]
+        row += [f"{report['recall'][k]:.3f}" for k in ks]
+        row += [f"{report['mrr']:.3f}", f"{report['retrieval_ms']:.1f}"]
+        row += [f"{report[key]:.3f}" if report[key] is not None else "-"
+                for key in ("min_relevant_score", "max_off_topic_score", "suggested_min_score")]
+        if judged:
+            row += [str(report.get("num_judged", "-")),
+                    f"{report['accuracy']:.3f}" if "accuracy" in report else "-",
+                    f"{report['end_to_end_s']:.1f}" if "end_to_end_s" in report else "-"]
+        print(" | ".join(row))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate retrieval quality of one or more Chroma databases.")
+    parser.add_argument("--dataset", default=EVAL_DATASET_PATH, help="Labeled question -> expected source dataset.")
+    parser.add_argument("--chroma", nargs="+", default=[CHROMA_PATH],
+                        help="Chroma databases to compare, e.g. one per chunking setting.")
+    parser.add_argument("--k", nargs="+", type=int, default=[1, 3, 5], help="Cutoffs for recall@k.")
+    parser.add_argument("--judge", action="store_true",
+                        help="Also run the LLM-judged end-to-end cases.")
+    parser.add_argument("--workers", type=int, default=4,
+                        help="Concurrent end-to-end cases when --judge is set.")
+    args = parser.parse_args()
+
+    cases = load_eval_dataset(args.dataset)
+    ks = sorted(set(args.k))
+
+    reports = []
+    for chroma_path in args.chroma:
+        report = evaluate_retrieval(cases, chroma_path=chroma_path, ks=ks)
+        if args.judge:
+            report.update(evaluate_end_to_end(cases, chroma_path=chroma_path, max_workers=args.workers))
+        reports.append(report)
+
+    print_report(reports, ks)
+
+
+if __name__ == "__main__":
+    main()